@@ -4,16 +4,38 @@ import os
 from os import path
 import json
 import fcntl
+import stat
 import argparse
-import platform
-import zipfile
 import signal
+import functools
+import re
+import time
 from contextlib import contextmanager
-import shutil
-import subprocess
-import select
+
+try:
+    import orjson
+    def json_load(f):
+        return orjson.loads(f.read())
+    json_loads = orjson.loads
+    json_dumpb = orjson.dumps
+except ImportError:
+    def json_load(f):
+        return json.load(f)
+    json_loads = json.loads
+    def json_dumpb(obj):
+        return json.dumps(obj).encode()
+
+LOG_FLUSH_THRESHOLD = 64 * 1024
+CHILD_READ_SIZE = 64 * 1024
+CHILD_PIPE_SIZE = 1024 * 1024
+VERSION_NUMBER_RE = re.compile(r'^(\d+)\.(\d+)\.(\d+)-m(\d+)$')
+# in seconds
+LOG_FLUSH_INTERVAL = 1.0
 
 platform_reh_name = None
+# (directory exists, zip file exists) for platform_reh_name
+platform_reh_presence = None
+reh_bin_path = None
 config = None
 
 def printe(*args, **kwargs):
@@ -35,39 +57,33 @@ class ConfigAccessor:
     }
 
     def __init__(self, configdata: dict):
-        self._configdata = configdata
-        # create the necessary directories
-        for key_with_path in ["data_dir", "ext_dir", "extract_dir", "pidfile", "logfile"]:
-            dirpath = path.dirname(getattr(self, key_with_path))
-            if dirpath:
-                os.makedirs(dirpath, exist_ok=True)
-
-    def __getattribute__(self, name: str):
-        if name in ConfigAccessor._default_values:
-            return self._configdata.get(name,
-                self._default_values[name])
-        else:
-            return super().__getattribute__(name)
+        # resolve all config values upfront so that reads are plain attribute lookups
+        for name, default_value in self._default_values.items():
+            setattr(self, name, configdata.get(name, default_value))
+        # only ever used as command line arguments
+        self.port = str(self.port)
+        if self.token:
+            self.token = str(self.token)
+        # create the necessary directories, each distinct one only once
+        dirpaths = {path.dirname(self.__dict__[key_with_path]) for key_with_path in
+            ("data_dir", "ext_dir", "extract_dir", "pidfile", "logfile")} - {""}
+        for dirpath in dirpaths:
+            os.makedirs(dirpath, exist_ok=True)
 
 def reh_launch_command():
-    args = [
-        path.join(get_reh_dir_path(), 'bin', 'code-server-oss'),
+    return [
+        reh_bin_path,
         "--host", config.host,
         "--port", config.port,
         "--server-data-dir", config.data_dir,
         "--extensions-dir", config.ext_dir
-    ]
-    if config.token:
-        args.extend(["--connection-token", config.token])
-    else:
-        args.append("--without-connection-token")
-
-    return [str(i) for i in args]
+    ] + (["--connection-token", config.token] if config.token
+        else ["--without-connection-token"]) + list(config.extra_args)
 
 @contextmanager
 def acquire_lock_file(blocking=True):
     nb_flag = fcntl.LOCK_NB if not blocking else 0
-    with open(config.pidfile, 'a') as f:
+    with open(config.pidfile, 'ab') as f:
         try:
             fcntl.flock(f.fileno(), fcntl.LOCK_EX | nb_flag)
             yield f
@@ -78,20 +94,21 @@ def check_instance_running():
     '''
     Returns: PID, version
     '''
-    try:
-        with acquire_lock_file(blocking=False) as f:
+    with open(config.pidfile, 'ab+') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # acquire successful = previous instance is not running
+            # (the lock is released when the file is closed)
+            return None, None
+        except BlockingIOError:
             pass
-        # acquire successful = previous instance is not running
-        return None, None
-    except BlockingIOError:
-        pass
 
-    # Failed w/ blocking error = running. Let's actually parse the PID file.
-    with open(config.pidfile, 'r') as f:
+        # Failed w/ blocking error = running. Parse the PID file from the same fd.
         f.seek(0, 0)
-        d = json.load(f)
+        d = json_load(f)
     return d['pid'], d['version']
 
+@functools.lru_cache(maxsize=16)
 def extract_version_number_component(v):
     """
     Accepts version no. in the form of
@@ -99,15 +116,10 @@ def extract_version_number_component(v):
     So far, supermajor is always 1.
     Returns: (supermajor, major, minor, modrev)
     """
-    try:
-        supermajor, major, minor = v.split(".")
-        minor, modrev = minor.split("-")
-        if not modrev.startswith('m'):
-            raise ValueError()
-        modrev = modrev[1:]
-        return int(supermajor), int(major), int(minor), int(modrev)
-    except ValueError:
+    m = VERSION_NUMBER_RE.match(v)
+    if not m:
         raise ValueError(f"Version number '{v}' not recognized")
+    return tuple(map(int, m.groups()))
 
 def is_version_newer(now, other):
     assert any((now, other))
@@ -117,26 +129,34 @@ def is_version_newer(now, other):
     if other is None:
         # no zip file: always older
         return False
+    if now == other:
+        # same version: no need to parse
+        return False
     # both exists: do actual comparison
     return extract_version_number_component(other) > extract_version_number_component(now)
 
+@functools.lru_cache(maxsize=None)
 def get_version_number_from_existing():
     direxist, _ = dir_or_zip_exist()
     if not direxist:
         return None
-    with open(path.join(get_reh_dir_path(), 'package.json'), 'r') as f:
-        return get_version_number_from_pkg(f)
+    with open(path.join(get_reh_dir_path(), 'package.json'), 'rb') as f:
+        return get_version_number_from_pkg(f.read())
 
+@functools.lru_cache(maxsize=None)
 def get_version_number_from_zipfile():
     _, zipexist = dir_or_zip_exist()
     if not zipexist:
         return None
+    # main() always needs the zip version (also for dry run and an already running
+    # instance), so this is only skipped when no zip file is provided
+    import zipfile
     with zipfile.ZipFile(f'{platform_reh_name}.zip', 'r') as zipobj:
-        with zipobj.open(path.join(platform_reh_name, 'package.json')) as f:
-            return get_version_number_from_pkg(f)
+        return get_version_number_from_pkg(
+            zipobj.read(path.join(platform_reh_name, 'package.json')))
 
-def get_version_number_from_pkg(f):
-    pkginfo = json.load(f)
+def get_version_number_from_pkg(data):
+    pkginfo = json_loads(data)
     return pkginfo['version']
 
 def get_reh_dir_path(name=None):
@@ -146,48 +166,116 @@ def get_reh_dir_path(name=None):
 
 def dir_or_zip_exist(name=None):
     if name is None:
-        name = platform_reh_name
+        # already probed by populate_platform_reh_name_paths
+        return platform_reh_presence
     return path.isdir(get_reh_dir_path(name)), path.isfile(f'{name}.zip')
 
+def scan_dir_entries(dirpath):
+    try:
+        with os.scandir(dirpath) as it:
+            return {entry.name: entry for entry in it}
+    except OSError:
+        # missing, not a directory, no permission, ...: same as path.isdir failing
+        return {}
+
 def populate_platform_reh_name_paths():
-    global platform_reh_name
+    global platform_reh_name, platform_reh_presence, reh_bin_path
 
     try:
         PREFIX = 'vscode-reh-'
+        uname = os.uname()
         plat_suffixes = {
             ('Darwin', 'arm64'): ['darwin-arm64'],
             ('Linux', 'x86_64'): ['linux-x64', 'linux-legacy-x64'],
             ('Linux', 'aarch64'): ['linux-arm64', 'linux-legacy-arm64'],
-        }.get((platform.system(), platform.machine()))
+        }.get((uname.sysname, uname.machine))
 
         if not plat_suffixes:
-            raise RuntimeError(f"Platform {platform.system()} {platform.machine()} not supported.")
+            raise RuntimeError(f"Platform {uname.sysname} {uname.machine} not supported.")
 
-        # scan current directory for the presence of the .zip file and the folder
+        # scan current directory for the .zip file and extract directory for the folder,
+        # listing each directory once instead of stat-ing every candidate
+        zip_entries = scan_dir_entries('.')
+        if path.abspath(config.extract_dir) == path.abspath('.'):
+            extract_entries = zip_entries
+        else:
+            extract_entries = scan_dir_entries(config.extract_dir)
         available_names = []
         for suffix in plat_suffixes:
             plat_name_to_chk = f'{PREFIX}{suffix}'
-            if any(dir_or_zip_exist(plat_name_to_chk)):
-                available_names.append(plat_name_to_chk)
+            dir_entry = extract_entries.get(plat_name_to_chk)
+            zip_entry = zip_entries.get(f'{plat_name_to_chk}.zip')
+            presence = (bool(dir_entry and dir_entry.is_dir()),
+                bool(zip_entry and zip_entry.is_file()))
+            if any(presence):
+                available_names.append((plat_name_to_chk, presence))
 
         if len(available_names) > 1:
             raise RuntimeError("Multiple VSCode REH with different platform suffix found.")
         elif not available_names:
             raise RuntimeError("No VSCode REH detected.")
 
-        platform_reh_name = available_names[0]
+        platform_reh_name, platform_reh_presence = available_names[0]
+        reh_bin_path = path.join(get_reh_dir_path(), 'bin', 'code-server-oss')
     except Exception as ex:
         printe(str(ex))
         sys.exit(1)
 
 def replace_extracted_version():
+    global platform_reh_presence
+
+    import glob
+    import tempfile
+    import zipfile
+
     # assume that the directory is unused and ready to be erased
     direxist, _ = dir_or_zip_exist()
     if direxist:
         print("Removing existing REH ...")
-        shutil.rmtree(get_reh_dir_path())
+        # move it out of the way (cheap) and let rm delete it in the background,
+        # so that extraction does not have to wait for it
+        old_reh_parent_path = tempfile.mkdtemp(prefix=f'{platform_reh_name}.old-',
+            dir=config.extract_dir)
+        os.rename(get_reh_dir_path(), path.join(old_reh_parent_path, platform_reh_name))
+        # also sweep the leftovers of previously interrupted removals
+        # (this includes the one just created)
+        old_reh_paths = glob.glob(path.join(glob.escape(config.extract_dir),
+            'vscode-reh-*.old-*'))
+        # sh puts rm in the background and exits right away: rm gets reparented instead of
+        # staying a zombie of this process, and its stdio goes to /dev/null
+        rm_pid = os.posix_spawn('/bin/sh',
+            ['sh', '-c', 'rm -rf -- "$@" &', 'sh'] + old_reh_paths, os.environ,
+            file_actions=[(os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_RDWR, 0)
+                for fd in range(3)],
+            setpgroup=0)
+        os.waitpid(rm_pid, 0)
     print("Extracting REH from zip file ...")
-    subprocess.run(["unzip", "-q", f'{platform_reh_name}.zip', '-d', config.extract_dir])
+    with open(f'{platform_reh_name}.zip', 'rb', buffering=1 << 20) as zf, \
+            zipfile.ZipFile(zf, 'r') as zipobj:
+        # zipfile does not restore symlinks and permission bits (unlike unzip), and the REH
+        # needs its executables to stay executable
+        dir_modes = []
+        for info in zipobj.infolist():
+            mode = info.external_attr >> 16
+            # sanitized path that zipfile actually wrote to
+            extracted_path = zipobj.extract(info, config.extract_dir)
+            if stat.S_ISLNK(mode):
+                # zipfile writes the link target as the file's content
+                link_target = zipobj.read(info).decode()
+                os.unlink(extracted_path)
+                os.symlink(link_target, extracted_path)
+            # like unzip without -K: setuid/setgid/sticky bits are not restored
+            elif mode & 0o777:
+                if info.is_dir():
+                    # apply after everything is extracted, in case it is read-only
+                    dir_modes.append((extracted_path, mode & 0o777))
+                else:
+                    os.chmod(extracted_path, mode & 0o777)
+        for extracted_path, mode in reversed(dir_modes):
+            os.chmod(extracted_path, mode)
+    # extracted directory and version have changed
+    platform_reh_presence = dir_or_zip_exist(platform_reh_name)
+    get_version_number_from_existing.cache_clear()
 
 def daemonize():
     sys.stdout.flush()
@@ -214,7 +302,9 @@ def daemonize():
     null_se = os.open('/dev/null', os.O_WRONLY)
     os.dup2(null_se, sys.stderr.fileno())
 
-def do_start_reh(foreground, reh_launch_args: list):
+def do_start_reh(foreground, reh_launch_args: list, existing_version):
+    import selectors
+
     if not foreground:
         daemonize()
 
@@ -225,56 +315,111 @@ def do_start_reh(foreground, reh_launch_args: list):
         print(f"Launcher's PID:", os.getpid())
         print(f"Log file:", logfile)
 
-    with open(logfile, 'wb') as logf:
+    with open(logfile, 'wb', buffering=LOG_FLUSH_THRESHOLD) as logf:
         # write PID file
         with acquire_lock_file() as f:
-            f.seek(0, 0)
-            f.truncate()
-            json.dump({
+            pidfile_data = json_dumpb({
                 "pid": os.getpid(),
-                "version": get_version_number_from_existing()
-            }, f)
-            f.flush()
-
-            process = subprocess.Popen(reh_launch_args, text=False,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                preexec_fn=os.setpgrp)
+                "version": existing_version
+            })
+            # file is opened for append: after truncating, the write lands at offset 0
+            os.ftruncate(f.fileno(), 0)
+            os.write(f.fileno(), pidfile_data)
+
+            # posix_spawn in its own process group (no fork of this process needed),
+            # with stdout/err redirected to pipes
+            stdout_rd, stdout_wr = os.pipe()
+            stderr_rd, stderr_wr = os.pipe()
+            spawn_file_actions = [
+                (os.POSIX_SPAWN_DUP2, stdout_wr, sys.stdout.fileno()),
+                (os.POSIX_SPAWN_DUP2, stderr_wr, sys.stderr.fileno()),
+            ]
+            # like Popen's close_fds: don't pass fds inherited by the launcher on to the REH
+            if hasattr(os, 'POSIX_SPAWN_CLOSEFROM'):
+                spawn_file_actions.append((os.POSIX_SPAWN_CLOSEFROM, 3))
+            else:
+                for fd in os.listdir('/dev/fd'):
+                    fd = int(fd)
+                    if fd > 2:
+                        try:
+                            os.set_inheritable(fd, False)
+                        except OSError:
+                            # e.g. the fd used to list /dev/fd itself, already closed
+                            pass
+            try:
+                child_pid = os.posix_spawn(reh_launch_args[0], reh_launch_args, os.environ,
+                    file_actions=spawn_file_actions,
+                    setpgroup=0,
+                    # Python ignores these: give the REH the defaults back, like Popen does
+                    setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+            finally:
+                # write ends belong to the child only
+                os.close(stdout_wr)
+                os.close(stderr_wr)
+            child_stdout = os.fdopen(stdout_rd, 'rb')
+            child_stderr = os.fdopen(stderr_rd, 'rb')
 
             stdouterrfdmap = {
-                process.stdout.fileno(): (sys.stdout.buffer.raw, process.stdout),
-                process.stderr.fileno(): (sys.stderr.buffer.raw, process.stderr),
+                stdout_rd: (sys.stdout.fileno(), child_stdout.readinto1),
+                stderr_rd: (sys.stderr.fileno(), child_stderr.readinto1),
             }
 
-            pfd = select.poll()
-            # make the child's stdout/err for nonblocking and register them for poll
+            sel = selectors.DefaultSelector()
+            # make the child's stdout/err for nonblocking and register them for select
             for fd in stdouterrfdmap:
+                # Linux only: enlarge the pipe so the child can write more before blocking
+                if hasattr(fcntl, 'F_SETPIPE_SZ'):
+                    try:
+                        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, CHILD_PIPE_SIZE)
+                    except OSError:
+                        pass
                 os.set_blocking(fd, False)
-                pfd.register(fd, select.POLLIN)
+                sel.register(fd, selectors.EVENT_READ, stdouterrfdmap[fd])
 
             # child's stdout/err read buffer
-            rdbuff = bytearray(4096)
+            rdbuff = bytearray(CHILD_READ_SIZE)
             rdbuffview = memoryview(rdbuff)
 
+            # bytes written to the log file but not yet flushed
+            log_pending = 0
+            log_flush_deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            logf_write = logf.write
+
             try:
-                while True:
-                    for fd, _event in pfd.poll():
+                # run until the child closes both stdout and stderr
+                while sel.get_map():
+                    # only wake up for the flush deadline if there is something to flush
+                    events = sel.select(max(0, log_flush_deadline - time.monotonic())
+                        if log_pending else None)
+                    for key, _event in events:
+                        out_fd, readinto1 = key.data
                         while True:
-                            rdlen = stdouterrfdmap[fd][1].readinto1(rdbuff)
-                            if not rdlen:
+                            rdlen = readinto1(rdbuff)
+                            if rdlen == 0:
+                                # EOF
+                                sel.unregister(key.fd)
+                                break
+                            if rdlen is None:
+                                # no more data for now
                                 break
                             rddata = rdbuffview[:rdlen]
                             if foreground:
-                                # to stdout/err
-                                stdouterrfdmap[fd][0].write(rddata)
+                                # to stdout/err, straight to the fd
+                                os.write(out_fd, rddata)
                             # to file
-                            logf.write(rddata)
-                            logf.flush()
+                            logf_write(rddata)
+                            log_pending += rdlen
+                    if log_pending and (log_pending >= LOG_FLUSH_THRESHOLD or
+                            time.monotonic() >= log_flush_deadline):
+                        logf.flush()
+                        log_pending = 0
+                        log_flush_deadline = time.monotonic() + LOG_FLUSH_INTERVAL
             except KeyboardInterrupt:
                 print("Stop requested.")
             finally:
                 print("Stopping VSCode REH ...")
-                os.killpg(os.getpgid(process.pid), signal.SIGINT)
-                process.wait()
+                os.killpg(child_pid, signal.SIGINT)
+                os.waitpid(child_pid, 0)
 
 def termination_signal_handler(sig, frame):
     raise KeyboardInterrupt()
@@ -304,7 +449,7 @@ def main():
     # check config file
     try:
         with open(args.config, 'r') as f:
-            config_data = json.load(f)
+            config_data = json_load(f)
     except FileNotFoundError:
         # all default settings
         config_data = {}
@@ -356,7 +501,8 @@ def main():
     if is_version_newer(existing_version, zipfile_version):
         print("Provided zip file have newer version. Replacing existing ...")
         replace_extracted_version()
-    do_start_reh(args.foreground, reh_launch_args)
+        existing_version = get_version_number_from_existing()
+    do_start_reh(args.foreground, reh_launch_args, existing_version)
 
 if __name__ == "__main__":
     main()